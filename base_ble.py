@@ -1,5 +1,5 @@
 from uuid import UUID
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from abc import ABC, abstractmethod
 from typing import Set, Optional, Any
 #from structures.slots import slots
@@ -7,6 +7,20 @@ from concurrency.sm.mp import Event
 from structures.datadict import DataDict
 
 
+def _as_uuid(value: str | UUID) -> UUID:
+    """
+    Приведение значения к UUID без повторного разбора,
+    если передан уже готовый объект UUID
+
+    Args:
+        value (str | UUID): UUID в виде строки или объекта
+    Returns:
+        uuid (UUID): Объект UUID
+    """
+
+    return value if isinstance(value, UUID) else UUID(str(value))
+
+
 @dataclass(init = False, slots = True)
 class DeviceUuids:
     """
@@ -18,11 +32,22 @@ class DeviceUuids:
             UUID характеристики для записи данных
         notify (Optional[str | UUID]):
             UUID характеристики для получения уведомлений
+        service_str (str):
+            Строковое представление UUID сервиса,
+            в том виде, в каком его возвращает BlueZ
+        write_str (Optional[str]):
+            Строковое представление UUID характеристики для записи
+        notify_str (Optional[str]):
+            Строковое представление UUID характеристики уведомлений
     """
 
     service: UUID  # UUID сервиса BLE устройства
     write: Optional[UUID]  # UUID характеристики для записи данных
     notify: Optional[UUID]  # UUID характеристики для получения уведомлений
+    # Строки UUID для сравнения с данными BlueZ без повторного форматирования:
+    service_str: str = field(repr = False, compare = False)
+    write_str: Optional[str] = field(repr = False, compare = False)
+    notify_str: Optional[str] = field(repr = False, compare = False)
 
     def __init__(
             self,
@@ -32,9 +57,14 @@ class DeviceUuids:
         ):
 
         # Устанавливаем UUID устройства:
-        self.service = UUID(str(service))
-        self.write = UUID(str(write))
-        self.notify = UUID(str(notify))
+        self.service = _as_uuid(service)
+        self.write = None if write is None else _as_uuid(write)
+        self.notify = None if notify is None else _as_uuid(notify)
+
+        # BlueZ отдаёт UUID в нижнем регистре, как и str(UUID):
+        self.service_str = str(self.service)
+        self.write_str = None if self.write is None else str(self.write)
+        self.notify_str = None if self.notify is None else str(self.notify)
 
 
 
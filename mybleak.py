@@ -1,5 +1,5 @@
 from base_ble import *
-import dbus, time
+import dbus, queue, os
 import dbus.mainloop.glib
 from gi.repository import GLib
 
@@ -7,6 +7,10 @@ class BluetoothError(Exception):
     pass
 
 class BleGatt(BaseBle):
+    # Кэш путей GATT атрибутов, общий для всех экземпляров. Пути зависят и от UUID:
+    # (address, service, write, notify) -> (service_path, write_char_path, notify_char_path, write_without_response)
+    _gatt_cache: dict[tuple, tuple] = {}
+
     def __init__(self, address: Optional[str] = None, uuids: Optional[DeviceUuids] = None, is_server: bool = False, server_search_time: float | None = None):
         super().__init__(address, uuids, is_server, server_search_time)
 
@@ -19,6 +23,21 @@ class BleGatt(BaseBle):
             self._dbussetting()
         self.address = address
         self.uuids = uuids
+        self._device_address = None
+        self._svc_path = None
+        self._write_char = None
+        self._write_without_response = False
+        self._notify_char = None
+        self._notify_char_path = None
+        # Уведомления копятся в очереди между вызовами read_packet
+        self._rx_queue = queue.Queue()
+        self._rx_receiver = None
+        # Сокеты AcquireWrite/AcquireNotify: данные идут мимо D-Bus
+        self._write_fd = None
+        self._write_mtu = 0
+        self._write_acquirable = False  # AcquireWrite ещё не отказывал
+        self._notify_fd = None
+        self._notify_mtu = 0
        
 
         
@@ -26,26 +45,77 @@ class BleGatt(BaseBle):
 
     def _dbussetting(self):
         self.bus = dbus.SystemBus()
-        self.manager = dbus.Interface(self.bus.get_object(self._busname, "/"), self._obj_manager_iface)
-        self.adapter_path = None
-        for path, ifaces in self.manager.GetManagedObjects().items():
-            if self._adapter_iface in ifaces:
-                self.adapter_path = path
-                break
-
-        if not self.adapter_path:
+        # Прокси объектов BlueZ по (путь, интерфейс), чтобы не создавать их заново
+        self._iface_cache: dict[tuple[str, str], dbus.Interface] = {}
+        self.manager = self._iface("/", self._obj_manager_iface)
+        # Кэш дерева объектов BlueZ и индексы по интерфейсу и по UUID,
+        # сбрасываются по сигналам ObjectManager
+        self._objs = None
+        self._by_iface = None
+        self._by_uuid = None
+        for signal_name in ("InterfacesAdded", "InterfacesRemoved"):
+            self.bus.add_signal_receiver(
+                self._invalidate_objs,
+                dbus_interface=self._obj_manager_iface,
+                signal_name=signal_name,
+                bus_name=self._busname
+            )
+        adapters = self._iface_index().get(self._adapter_iface)
+        if not adapters:
             raise BluetoothError("Not Found Bluetooth adapter")
+        self.adapter_path = adapters[0][0]
         
-        self.adapter = dbus.Interface(
-        self.bus.get_object("org.bluez", self.adapter_path),
-    self._adapter_iface
-    
-)
-        self.adapter_prob = dbus.Interface(
-    self.bus.get_object("org.bluez", self.adapter_path),
-    "org.freedesktop.DBus.Properties"
-)
+        self.adapter = self._iface(self.adapter_path, self._adapter_iface)
+        self.adapter_prob = self._iface(self.adapter_path, "org.freedesktop.DBus.Properties")
     
+    def _iface(self, path, name):
+        key = (str(path), name)
+        iface = self._iface_cache.get(key)
+        if iface is None:
+            iface = dbus.Interface(self.bus.get_object(self._busname, path), name)
+            self._iface_cache[key] = iface
+        return iface
+
+    def _invalidate_objs(self, *args):
+        self._objs = None
+        self._by_iface = None
+        self._by_uuid = None
+
+    def _managed_objects(self):
+        # Обрабатываем накопившиеся сигналы, чтобы кэш не устарел
+        context = GLib.MainContext.default()
+        while context.pending():
+            context.iteration(False)
+        if self._objs is None:
+            self._objs = self.manager.GetManagedObjects()
+        return self._objs
+
+    def _iface_index(self):
+        # интерфейс -> [(путь, свойства), ...], один проход по дереву
+        objs = self._managed_objects()
+        if self._by_iface is None:
+            by_iface: dict[str, list[tuple[str, dict]]] = {}
+            for path, ifaces in objs.items():
+                for iface, props in ifaces.items():
+                    by_iface.setdefault(iface, []).append((path, props))
+            self._by_iface = by_iface
+        return self._by_iface
+
+    def _uuid_index(self):
+        # (интерфейс, путь родителя, UUID) -> путь атрибута GATT
+        by_iface = self._iface_index()
+        if self._by_uuid is None:
+            parents = {
+                "org.bluez.GattService1": "Device",
+                "org.bluez.GattCharacteristic1": "Service"
+            }
+            self._by_uuid = {
+                (iface, str(props[parent]), str(props["UUID"])): path
+                for iface, parent in parents.items()
+                for path, props in by_iface.get(iface, ())
+            }
+        return self._by_uuid
+
     def set_self_name(self, adapter_name: str) -> bool:
         return super().set_self_name(adapter_name)
     
@@ -54,18 +124,122 @@ class BleGatt(BaseBle):
     
     def connect(self, device: Any) -> bool:
         if device:
-            self.device_path = None
-            for path, ifaces in self.manager.GetManagedObjects().items():
-                dev = ifaces.get("org.bluez.Device1")
-                if dev and dev.get("Address") == device:
-                    self.device_path = path
-                    
-                    break
-
-            if not self.device_path:
+            # Путь устройства в BlueZ строится из пути адаптера и MAC-адреса
+            self.device_path = f"{self.adapter_path}/dev_{device.upper().replace(':', '_')}"
+            if self.device_path not in self._managed_objects():
                 raise Exception("Устройство не найдено")
-            self.device = dbus.Interface(self.bus.get_object("org.bluez", self.device_path), "org.bluez.Device1")
+            self.device = self._iface(self.device_path, self._device_iface)
+            self._device_address = device
+            # Подписка и сокеты прошлого соединения снимаются до сброса прокси
+            self._stop_notify()
+            self._release_write()
+            self._svc_path = None
+            self._write_char = None
+            self._notify_char = None
+            self._notify_char_path = None
         self.device.Connect()
+        cached = self._gatt_cache.get(self._cache_key())
+        if cached is not None and self._svc_path is None:
+            objs = self._managed_objects()
+            if all(not path or path in objs for path in cached[:3]):
+                self._set_paths(*cached)
+            else:
+                # Пути устарели или ещё не экспортированы: запись выбрасываем,
+                # write/read_packet найдут атрибуты заново через _resolve_paths
+                del self._gatt_cache[self._cache_key()]
+        # Соединение держится до close(), write/read_packet его не переоткрывают
+        self.run()
+
+    def _cache_key(self):
+        uuids = self.uuids
+        return (self._device_address, uuids.service_str, uuids.write_str, uuids.notify_str)
+
+    def _set_paths(self, svc_path, write_path, notify_path, write_without_response=False):
+        self._stop_notify()
+        self._release_write()
+        self._svc_path = svc_path
+        self._write_without_response = write_without_response
+        self._write_acquirable = write_without_response
+        self._write_char = None
+        self._notify_char = None
+        self._notify_char_path = notify_path
+        if write_path:
+            self._write_char = self._iface(write_path, "org.bluez.GattCharacteristic1")
+        if notify_path:
+            self._notify_char = self._iface(notify_path, "org.bluez.GattCharacteristic1")
+            self._start_notify()
+
+    def _acquire_write(self):
+        try:
+            fd, mtu = self._write_char.AcquireWrite({})
+        except dbus.exceptions.DBusException:
+            # BlueZ не поддерживает, пишем через WriteValue и больше не просим
+            self._write_acquirable = False
+            return
+        self._write_fd = fd.take()
+        self._write_mtu = int(mtu)
+
+    def _release_write(self):
+        if self._write_fd is not None:
+            os.close(self._write_fd)
+            self._write_fd = None
+
+    def _start_notify(self):
+        try:
+            fd, mtu = self._notify_char.AcquireNotify({})
+        except dbus.exceptions.DBusException:
+            pass
+        else:
+            self._notify_fd = fd.take()
+            self._notify_mtu = int(mtu)
+            return
+
+        # Подписка держится всю сессию, а не на время одного read_packet
+        # byte_arrays: Value приходит как dbus.ByteArray (подкласс bytes),
+        # а не как массив dbus.Byte
+        self._rx_receiver = self.bus.add_signal_receiver(
+            self.handler,
+            signal_name="PropertiesChanged",
+            dbus_interface="org.freedesktop.DBus.Properties",
+            path=self._notify_char_path,
+            byte_arrays=True
+        )
+        self._notify_char.StartNotify()
+
+    def _stop_notify(self):
+        if self._notify_fd is not None:
+            # Закрытие сокета отключает уведомления в BlueZ
+            os.close(self._notify_fd)
+            self._notify_fd = None
+        if self._rx_receiver is None:
+            return
+        self._rx_receiver.remove()
+        self._rx_receiver = None
+        if self._notify_char is None:
+            return
+        try:
+            self._notify_char.StopNotify()
+        except dbus.exceptions.DBusException:
+            pass  # устройство уже отключено
+
+    def _resolve_paths(self):
+        by_uuid = self._uuid_index()
+        svc_path = by_uuid.get(("org.bluez.GattService1", self.device_path, self.uuids.service_str))
+        if not svc_path:
+            raise Exception("Сервис не найден")
+
+        write_path = by_uuid.get(("org.bluez.GattCharacteristic1", svc_path, self.uuids.write_str))
+        write_flags = ()
+        if write_path:
+            write_flags = self._managed_objects()[write_path]["org.bluez.GattCharacteristic1"].get("Flags", ())
+        paths = (
+            svc_path,
+            write_path,
+            by_uuid.get(("org.bluez.GattCharacteristic1", svc_path, self.uuids.notify_str)),
+            "write-without-response" in write_flags
+        )
+        self._gatt_cache[self._cache_key()] = paths
+        self._set_paths(*paths)
     
     def connected(self) -> bool:
         return super().connected
@@ -76,26 +250,52 @@ class BleGatt(BaseBle):
     def discover(self, scan_duration: float = 10.) -> Set[Any]:
         if not self.is_bluetooth_on():
             raise BluetoothError("Bluetooth is off")
-        devicelist = []
-        self.adapter.StartDiscovery()
-        start = time.time()
-        while time.time() - start < scan_duration:
-            objects = self.manager.GetManagedObjects()
-            for path, ifaces in objects.items():
-                if self._device_iface in ifaces:
-                    props = ifaces[self._device_iface]
-                    addr = props.get("Address")
-                    name = props.get("Name") or props.get("Alias")
-                    rssi = props.get("RSSI")
-                    data = {"addr": str(addr), "name": str(name), "rssi": str(rssi)}
-                    if addr and data not in devicelist:
-                        devicelist.append(data)
-            time.sleep(0.01)
-        self.adapter.StopDiscovery()
-        return devicelist
+        devicemap: dict[str, dict] = {}  # адрес -> информация об устройстве
+
+        dev_iface = self._device_iface
+
+        def add_device(props):
+            addr = props.get("Address")
+            # Строки собираем только для ещё не встреченного устройства
+            if not addr or addr in devicemap:
+                return
+            name = props.get("Name") or props.get("Alias")
+            rssi = props.get("RSSI")
+            devicemap[str(addr)] = {"addr": str(addr), "name": str(name), "rssi": str(rssi)}
+
+        def on_interfaces_added(path, ifaces):
+            if dev_iface in ifaces:
+                add_device(ifaces[dev_iface])
+
+        # Устройства, уже известные BlueZ, перечисляем один раз по свежему
+        # снимку дерева (Name и RSSI могли измениться), новые приходят
+        # сигналом InterfacesAdded
+        self._invalidate_objs()
+        for path, props in self._iface_index().get(dev_iface, ()):
+            add_device(props)
+        receiver = self.bus.add_signal_receiver(
+            on_interfaces_added,
+            dbus_interface=self._obj_manager_iface,
+            signal_name="InterfacesAdded",
+            bus_name=self._busname
+        )
+
+        loop = GLib.MainLoop()
+        try:
+            self.adapter.StartDiscovery()
+            try:
+                GLib.timeout_add(int(scan_duration * 1000), loop.quit)
+                loop.run()
+            finally:
+                self.adapter.StopDiscovery()
+        finally:
+            receiver.remove()
+        return list(devicemap.values())
 
     def fileno(self) -> int:
-        return super().fileno()
+        if self._notify_fd is None:
+            raise BluetoothError("Notify socket is not acquired")
+        return self._notify_fd
     
     def get_event(self) -> Event:
         return super().get_event()
@@ -129,51 +329,76 @@ class BleGatt(BaseBle):
 
     def handler(self, iface, changed, invalidated):
         if "Value" in changed:
-            self.received = bytes(changed["Value"])
-            self.loop.quit()
+            self._rx_queue.put(changed["Value"])
 
 
     def read_packet(self) -> bytes: 
-        
-        
-        objs = self.manager.GetManagedObjects()
-        self.received = None
-        svc_path = next(p for p, ifs in objs.items()
-    if "org.bluez.GattService1" in ifs
-    and ifs["org.bluez.GattService1"]["UUID"] == str(self.uuids.service)
-    and str(ifs["org.bluez.GattService1"]["Device"]) == self.device_path)
-
-# --- find characteristic ---
-        char_path = next(p for p, ifs in objs.items()
-    if "org.bluez.GattCharacteristic1" in ifs
-    and ifs["org.bluez.GattCharacteristic1"]["UUID"] == str(self.uuids.notify)
-    and str(ifs["org.bluez.GattCharacteristic1"]["Service"]) == svc_path)
-
-        char = dbus.Interface(self.bus.get_object("org.bluez", char_path),
-                      "org.bluez.GattCharacteristic1")
-        self.bus.add_signal_receiver(
-    self.handler,                # bound method
-    signal_name="PropertiesChanged",
-    dbus_interface="org.freedesktop.DBus.Properties",
-    path=char_path
-)       
-        self.loop = GLib.MainLoop()
-        char.StartNotify()
-        self.loop.run()           # ждём первое уведомление
-        char.StopNotify()
-        return self.received
+        if not self.is_open:
+            raise BluetoothError("Not connected")
+        if self._svc_path is None:
+            self._resolve_paths()
+        if self._notify_char is None:
+            raise Exception("Характеристика не найдена")
+
+        if self._notify_fd is not None:
+            # Одно уведомление - один пакет SEQPACKET сокета
+            data = os.read(self._notify_fd, self._notify_mtu)
+            if not data:
+                # BlueZ закрыл сокет: устройство отключилось
+                os.close(self._notify_fd)
+                self._notify_fd = None
+                raise BluetoothError("Notify socket closed")
+            return data
+
+        # Крутим контекст GLib, пока обработчик не положит уведомление в очередь
+        context = GLib.MainContext.default()
+        while self._rx_queue.empty():
+            context.iteration(True)
+        return self._rx_queue.get_nowait()
 
     def receive(self) -> bytes:
         return super().receive()
 
     def set_bluetooth_power(self, state: bool) -> bool:
-        self.adapter.Set("org.bluez.Adapter1", "Powered", state)
-
-        powered = self.adapter_prob.Get("org.bluez.Adapter1", "Powered")
-        if not powered or powered:
+        # Адаптер уже в нужном состоянии - сигнала не будет, ждать нечего
+        if bool(self.adapter_prob.Get("org.bluez.Adapter1", "Powered")) == state:
             return True
-        else:
+        # Powered меняется асинхронно - ждём PropertiesChanged адаптера,
+        # а не читаем свойство сразу после Set
+        loop = GLib.MainLoop()
+        observed = []
+
+        def on_properties_changed(iface, changed, invalidated):
+            if "Powered" in changed:
+                observed.append(bool(changed["Powered"]))
+                loop.quit()
+
+        def on_timeout():
+            loop.quit()
+            return False
+
+        receiver = self.bus.add_signal_receiver(
+            on_properties_changed,
+            dbus_interface="org.freedesktop.DBus.Properties",
+            signal_name="PropertiesChanged",
+            arg0="org.bluez.Adapter1",
+            path=self.adapter_path
+        )
+        try:
+            self.adapter_prob.Set("org.bluez.Adapter1", "Powered", dbus.Boolean(state))
+            timeout_id = GLib.timeout_add(5000, on_timeout)
+            loop.run()
+            if observed:
+                GLib.source_remove(timeout_id)
+        except dbus.exceptions.DBusException:
             return False
+        finally:
+            receiver.remove()
+
+        if not observed:
+            # Сигнал не пришёл за отведённое время - проверяем свойство напрямую
+            return bool(self.adapter_prob.Get("org.bluez.Adapter1", "Powered")) == state
+        return observed[-1] == state
 
     def set_event(self, event: Event):
         return super().set_event(event)
@@ -182,42 +407,58 @@ class BleGatt(BaseBle):
         return super().set_timeout(timeout)
     
     
-    def write(self, data: bytes) -> bool:
-        
-    # найти сервис
-        service_path = None
-        for path, ifaces in self.manager.GetManagedObjects().items():
-            svc = ifaces.get("org.bluez.GattService1")
-            if svc and svc.get("UUID") == str(self.uuids.service) and svc.get("Device") == self.device_path:
-                service_path = path
-                break
-
-        if not service_path:
-            raise Exception("Сервис не найден")
-
-    # найти характеристику
-        char_path = None
-        for path, ifaces in self.manager.GetManagedObjects().items():
-            chr = ifaces.get("org.bluez.GattCharacteristic1")
-            if chr and chr.get("UUID") == str(self.uuids.write) and chr.get("Service") == service_path:
-                char_path = path
-                break
-
-        if not char_path:
+    def write(self, data: bytes, acknowledged: bool = False) -> bool:
+        if not self.is_open:
+            raise BluetoothError("Not connected")
+        if self._svc_path is None:
+            self._resolve_paths()
+        if self._write_char is None:
             raise Exception("Характеристика не найдена")
 
     # запись
-        char = dbus.Interface(self.bus.get_object("org.bluez", char_path),
-                          "org.bluez.GattCharacteristic1")
+        char = self._write_char
 
-        char.WriteValue([dbus.Byte(b) for b in data], {})
+        if acknowledged:
+            # Пока сокет AcquireWrite открыт, BlueZ отклоняет WriteValue ("Write acquired")
+            self._release_write()
+        elif self._write_fd is None and self._write_acquirable:
+            # Сокет берём при первой записи без подтверждения
+            self._acquire_write()
+        if not acknowledged and self._write_fd is not None:
+            # Запись в сокет AcquireWrite, кусками не больше полезной нагрузки ATT
+            mtu = self._write_mtu - 3
+            for i in range(0, len(data), mtu):
+                os.write(self._write_fd, data[i:i + mtu])
+            return True
+        # Write Without Response не ждёт подтверждения ATT на каждый пакет,
+        # подтверждаемая запись - по запросу или если характеристика иначе не умеет
+        if acknowledged or not self._write_without_response:
+            options = {}
+        else:
+            options = {"type": dbus.String("command")}
+        char.WriteValue(dbus.ByteArray(data), options)
 
         
         return True
     def recvall(self, size: int) -> bytes:
         return super().recvall(size)
-print(BleGatt().discover())
-ble = BleGatt(uuids = DeviceUuids("12345678-1234-5678-1234-56798abcdef0", "12345678-1234-5678-1234-56798abcdef1", "12345678-1234-5678-1234-56798abcdef2"))
-ble.connect("B8:27:EB:06:5D:3D")
-print(ble.write(b'$M<\x00\x01\x01'))
-print(ble.read_packet())
\ No newline at end of file
+
+    def close(self):
+        self._stop_notify()
+        self._release_write()
+        # После close() connect(None) заново поднимает подписку на уведомления
+        self._svc_path = None
+        self._write_char = None
+        self._notify_char = None
+        self._notify_char_path = None
+        if self.is_open:
+            self.device.Disconnect()
+        super().close()
+
+
+if __name__ == "__main__":
+    print(BleGatt().discover())
+    ble = BleGatt(uuids = DeviceUuids("12345678-1234-5678-1234-56798abcdef0", "12345678-1234-5678-1234-56798abcdef1", "12345678-1234-5678-1234-56798abcdef2"))
+    ble.connect("B8:27:EB:06:5D:3D")
+    print(ble.write(b'$M<\x00\x01\x01'))
+    print(ble.read_packet())
@@ -1,10 +1,21 @@
 #!/usr/bin/python3
+import os
+import signal
+import socket
+import threading
+import logging
+import collections
+import contextlib
 import dbus
 import dbus.exceptions
 import dbus.mainloop.glib
 import dbus.service
 from gi.repository import GLib
 
+# Обработчики D-Bus пишут на DEBUG: при выключенном уровне
+# вызов отсекается до форматирования данных
+log = logging.getLogger(__name__)
+
 BLUEZ_SERVICE_NAME = "org.bluez"
 GATT_MANAGER_IFACE = "org.bluez.GattManager1"
 LE_ADVERTISING_MANAGER_IFACE = "org.bluez.LEAdvertisingManager1"
@@ -13,12 +24,56 @@ DBUS_PROP_IFACE = "org.freedesktop.DBus.Properties"
 
 MAIN_LOOP = None
 
+# Типы dbus как глобальные имена: LOAD_GLOBAL вместо цепочки LOAD_ATTR
+_Array = dbus.Array
+_Boolean = dbus.Boolean
+_String = dbus.String
+_ByteArray = dbus.ByteArray
+_ObjectPath = dbus.ObjectPath
+_UnixFd = dbus.types.UnixFd
+
+# Ключи свойств GATT, обёрнутые в dbus.String один раз на процесс
+K_UUID = _String("UUID")
+K_PRIMARY = _String("Primary")
+K_CHARS = _String("Characteristics")
+K_SVC = _String("Service")
+K_FLAGS = _String("Flags")
+K_DESCS = _String("Descriptors")
+K_CHAR = _String("Characteristic")
+K_NOTIFY_ACQUIRED = _String("NotifyAcquired")
+K_VALUE = _String("Value")
+
+# Значения для ReadValue: неизменяемые, создаются один раз
+READ_VALUE = _ByteArray(b"OK")
+CCCD_VALUE = _ByteArray(b"\x01\x00")
+
+# Маркер "значение ещё не отправлялось" (в отличие от None или b"")
+_SENTINEL = object()
+
+# Период объединения уведомлений характеристики-состояния в одно, мс
+NOTIFY_COALESCE_MS = 10
+
 # =============================
 # UUIDs
 # =============================
-SERVICE_UUID = "12345678-1234-5678-1234-56789abcdef0"
-WRITE_UUID   = "12345678-1234-5678-1234-56789abcdef1"
-NOTIFY_UUID  = "12345678-1234-5678-1234-56789abcdef2"
+SERVICE_UUID = _String("12345678-1234-5678-1234-56789abcdef0")
+WRITE_UUID   = _String("12345678-1234-5678-1234-56789abcdef1")
+NOTIFY_UUID  = _String("12345678-1234-5678-1234-56789abcdef2")
+CCCD_UUID    = _String("00002902-0000-1000-8000-00805f9b34fb")
+
+# Флаги характеристик, уже в виде D-Bus массивов строк
+FLAGS_WRITE  = _Array(["write", "write-without-response"], signature="s")
+FLAGS_NOTIFY = _Array(["notify", "read"], signature="s")
+FLAGS_CCCD   = _Array(["read", "write"], signature="s")
+
+
+def _as_string(value):
+    # Уже обёрнутое значение используется как есть
+    return value if isinstance(value, _String) else _String(value)
+
+
+def _as_string_array(values):
+    return values if isinstance(values, _Array) else _Array(values, signature="s")
 
 
 # ============================================================
@@ -26,33 +81,71 @@ NOTIFY_UUID  = "12345678-1234-5678-1234-56789abcdef2"
 # ============================================================
 class Application(dbus.service.Object):
     PATH = "/example/gatt"
+    # dbus.service.Object сам держит __dict__, слоты ускоряют доступ к своим полям
+    __slots__ = ("path", "_path_obj", "services", "_managed")
 
     def __init__(self, bus):
         self.path = self.PATH
+        self._path_obj = _ObjectPath(self.path)
         self.services = []
+        # Плоская копия дерева объектов для GetManagedObjects,
+        # пополняется при добавлении сервисов, характеристик и дескрипторов
+        self._managed = {}
         super().__init__(bus, self.path)
 
     def add_service(self, service):
         self.services.append(service)
+        service.application = self
+        self._register(service)
+        for char in service.characteristics:
+            self._register_characteristic(char)
+
+    def remove_service(self, service):
+        self.services.remove(service)
+        for char in service.characteristics:
+            for desc in char.descriptors:
+                self._unregister(desc)
+                desc.remove_from_connection()
+            self._unregister(char)
+            char.release()
+        self._unregister(service)
+        service.remove_from_connection()
+        service.application = None
+
+    def _register(self, obj):
+        # Словари свойств кэшированы в самих объектах, храним ссылки на них
+        properties = obj.get_properties()
+        self._managed[obj._path_obj] = properties
+        # Подписчики ObjectManager узнают о новом объекте без повторного
+        # GetManagedObjects
+        self.InterfacesAdded(obj._path_obj, properties)
+
+    def _unregister(self, obj):
+        properties = self._managed.pop(obj._path_obj, None)
+        if properties is not None:
+            self.InterfacesRemoved(obj._path_obj, _Array(properties, signature="s"))
+
+    def _register_characteristic(self, char):
+        self._register(char)
+        for desc in char.descriptors:
+            self._register(desc)
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
     @dbus.service.method(DBUS_OM_IFACE, out_signature="a{oa{sa{sv}}}")
     def GetManagedObjects(self):
+        return self._managed
 
-        managed = {}
-
-        for service in self.services:
-            managed[service.get_path()] = service.get_properties()
-
-            for char in service.characteristics:
-                managed[char.get_path()] = char.get_properties()
-
-                for desc in char.descriptors:
-                    managed[desc.get_path()] = desc.get_properties()
+    # Клиентам, которым нужно живое дерево, достаточно один раз вызвать
+    # GetManagedObjects и дальше следить за этими сигналами
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oa{sa{sv}}")
+    def InterfacesAdded(self, path, interfaces):
+        pass
 
-        return managed
+    @dbus.service.signal(DBUS_OM_IFACE, signature="oas")
+    def InterfacesRemoved(self, path, interfaces):
+        pass
 
 
 # ============================================================
@@ -60,60 +153,126 @@ class Application(dbus.service.Object):
 # ============================================================
 class Service(dbus.service.Object):
     IFACE = "org.bluez.GattService1"
+    __slots__ = ("path", "_path_obj", "bus", "uuid", "primary",
+                 "characteristics", "application", "_char_paths", "_properties")
 
     def __init__(self, bus, index, uuid, primary):
         self.path = f"{Application.PATH}/service{index}"
+        self._path_obj = _ObjectPath(self.path)
         self.bus = bus
         self.uuid = uuid
         self.primary = primary
         self.characteristics = []
+        self.application = None  # устанавливается в Application.add_service
+        # Массив путей характеристик, лежит прямо в словаре свойств
+        self._char_paths = _Array([], signature="o")
+        # UUID и Primary не меняются, словарь свойств строится один раз
+        self._properties = self._build_properties()
         super().__init__(bus, self.path)
 
     def add_characteristic(self, characteristic):
         self.characteristics.append(characteristic)
+        # Словарь свойств ссылается на этот же массив, перестраивать его не нужно
+        self._char_paths.append(characteristic._path_obj)
+        if self.application is not None:
+            self.application._register_characteristic(characteristic)
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
-    def get_properties(self):
+    def _build_properties(self):
         return {
             self.IFACE: {
-                "UUID": self.uuid,
-                "Primary": self.primary,
+                K_UUID: _as_string(self.uuid),
+                K_PRIMARY: _Boolean(self.primary),
+                K_CHARS: self._char_paths,
             }
         }
 
+    def get_properties(self):
+        return self._properties
+
 
 # ============================================================
 # Characteristic
 # ============================================================
 class Characteristic(dbus.service.Object):
     IFACE = "org.bluez.GattCharacteristic1"
-
-    def __init__(self, bus, index, uuid, flags, service):
+    __slots__ = ("path", "_path_obj", "bus", "uuid", "flags", "service",
+                 "_svc_path_obj", "descriptors", "_desc_paths", "notifying",
+                 "notify_target", "state", "_properties", "_pending",
+                 "_timer_id", "_batching", "_batch_thread", "_queue",
+                 "_event_fd", "_event_watch", "_last_value", "_notify_fd",
+                 "_notify_mtu", "_notify_watch", "_emit")
+
+    def __init__(self, bus, index, uuid, flags, service, state=False):
         self.path = f"{service.path}/char{index}"
+        self._path_obj = _ObjectPath(self.path)
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
         self.service = service
+        self._svc_path_obj = service._path_obj
         self.descriptors = []
+        self._desc_paths = _Array([], signature="o")
         self.notifying = False
+        # Характеристика для эха записанных данных, задаётся в main()
+        self.notify_target = None
+        # state=True: значение-состояние, клиенту важно только последнее.
+        # По умолчанию характеристика - поток байт, и доходит каждый пакет
+        self.state = state
+        self._properties = self._build_properties()
+        # Значения, ожидающие отправки, и id таймера GLib
+        self._pending = []
+        self._timer_id = 0
+        self._batching = 0  # глубина вложенных batch()
+        self._batch_thread = None  # поток, открывший batch()
+        # Передача значений из любого потока в поток GLib без блокировок:
+        # производитель кладёт значение в очередь и будит цикл через eventfd.
+        # Состояния схлопываются до последнего уже в _stage, чтобы не потерять
+        # флаг force вытесненного значения. Характеристикам без notify/indicate очередь и eventfd не нужны
+        self._queue = None
+        self._event_fd = None
+        self._event_watch = 0
+        if "notify" in flags or "indicate" in flags:
+            self._queue = collections.deque()
+            self._event_fd = os.eventfd(0, os.EFD_NONBLOCK)
+            self._event_watch = GLib.io_add_watch(self._event_fd, GLib.PRIORITY_DEFAULT,
+                                                  GLib.IO_IN, self._drain)
+        self._last_value = _SENTINEL  # последнее отправленное значение
+        # Наш конец socketpair после AcquireNotify: уведомления пишутся в него напрямую
+        self._notify_fd = None
+        self._notify_mtu = 0
+        self._notify_watch = 0
         super().__init__(bus, self.path)
+        # Связанный метод сигнала, чтобы не разрешать его на каждое уведомление
+        self._emit = self.PropertiesChanged
 
     def add_descriptor(self, descriptor):
         self.descriptors.append(descriptor)
+        self._desc_paths.append(descriptor._path_obj)
+        if self.service.application is not None:
+            self.service.application._register(descriptor)
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
-    def get_properties(self):
-        return {
+    def _build_properties(self):
+        properties = {
             self.IFACE: {
-                "UUID": self.uuid,
-                "Service": self.service.get_path(),
-                "Flags": self.flags,
+                K_UUID: _as_string(self.uuid),
+                K_SVC: self._svc_path_obj,
+                K_FLAGS: _as_string_array(self.flags),
+                K_DESCS: self._desc_paths,
             }
         }
+        if "notify" in self.flags:
+            # Наличие свойства сообщает BlueZ, что поддерживается AcquireNotify
+            properties[self.IFACE][K_NOTIFY_ACQUIRED] = _Boolean(False)
+        return properties
+
+    def get_properties(self):
+        return self._properties
 
     # Signal — стандартный org.freedesktop.DBus.Properties.PropertiesChanged
     @dbus.service.signal(DBUS_PROP_IFACE, signature='sa{sv}as')
@@ -122,44 +281,198 @@ class Characteristic(dbus.service.Object):
         pass
 
     # WRITE Handler
-    @dbus.service.method(IFACE, in_signature="aya{sv}", out_signature="")
+    @dbus.service.method(IFACE, in_signature="aya{sv}", out_signature="", byte_arrays=True)
     def WriteValue(self, value, options):
-        # value приходит как массив байтов dbus.Byte (или список)
-        data_bytes = bytes(value)
-        print("WRITE received:", data_bytes)
+        # byte_arrays=True: value приходит как dbus.ByteArray (подкласс bytes),
+        # копировать его в bytes не нужно
+        data_bytes = value
+        log.debug("WRITE received: %r", data_bytes)
 
         # Если у этой характеристики есть связанная цель notify_target — отправляем уведомление туда
         # мы ожидаем, что в main() мы установим атрибут notify_target для write-характеристики
-        if hasattr(self, "notify_target") and self.notify_target is not None:
-            try:
-                # Подготовим dbus.Array байтов с сигнатурой 'y'
-                dbus_value = dbus.Array(value, signature='y')
-                # Отправляем сигнал PropertiesChanged на путь notify-характеристики
-                # Первый аргумент — интерфейс GATT Characteristic, второй — словарь изменённых свойств
-                self.notify_target.PropertiesChanged(self.notify_target.IFACE,
-                                                    {"Value": dbus_value},
-                                                    [])
-                print("Notified notify-characteristic with:", data_bytes)
-            except Exception as e:
-                print("Failed to send notification:", e)
+        target = self.notify_target
+        if target is not None:
+            target.send_notify(data_bytes)
+
+    def send_notify(self, data, force=False):
+        # Быстрый выход, пока клиент не подписан на уведомления
+        if not self.notifying or self._event_fd is None:
+            return
+        if self._batching and self._batch_thread == threading.get_ident():
+            # Вызов из самого batch() в потоке GLib: значение уйдёт при выходе из блока.
+            # Остальные потоки всегда идут через очередь и eventfd
+            self._stage(data, force)
+            return
+        # force едет вместе со значением и применяется в _flush, в потоке GLib
+        self._queue.append((data, force))
+        os.eventfd_write(self._event_fd, 1)
+
+    def _stage(self, data, force):
+        pending = self._pending
+        if self.state and pending:
+            # Промежуточные состояния не нужны, остаётся последнее;
+            # heartbeat вытесненного значения переходит к нему
+            force = force or pending[-1][1]
+            pending.clear()
+        pending.append((data, force))
+
+    def _drain(self, source, condition):
+        # Выполняется в потоке GLib: забираем значения из очереди
+        try:
+            os.eventfd_read(self._event_fd)
+        except BlockingIOError:
+            return True
+        queue = self._queue
+        while queue:
+            self._stage(*queue.popleft())
+        if not self._pending or self._batching:
+            return True
+        if not self.state:
+            # В потоке уходит каждый пакет, объединять нечего - отправляем сразу
+            self._flush()
+        elif self._timer_id == 0:
+            # Состояния за период таймера сводятся к одному уведомлению
+            self._timer_id = GLib.timeout_add(NOTIFY_COALESCE_MS, self._flush)
+        return True
+
+    @contextlib.contextmanager
+    def batch(self):
+        # Группировка обновлений: всё, что отправлено внутри блока, уходит при выходе
+        # из него (для состояния - одно уведомление с последним значением).
+        # Использовать только из потока GLib
+        if not self._batching:
+            self._batch_thread = threading.get_ident()
+        self._batching += 1
+        try:
+            yield self
+        finally:
+            self._batching -= 1
+            if not self._batching:
+                self._batch_thread = None
+                if self._pending:
+                    if self._timer_id:
+                        GLib.source_remove(self._timer_id)
+                    self._flush()
+
+    def _flush(self):
+        pending = self._pending
+        self._pending = []
+        self._timer_id = 0
+        if not self.notifying:
+            return False
+        for data, force in pending:
+            # Повтор того же состояния клиенту ничего не даёт, кроме heartbeat (force).
+            # В потоке одинаковые пакеты - разные сообщения, их не пропускаем
+            if self.state and not force and data == self._last_value:
+                continue
+            self._last_value = data
+            if not self._send(data):
+                break
+        return False  # одноразовый таймер
+
+    def _send(self, data):
+        try:
+            # dbus.ByteArray оборачивает буфер целиком, без dbus.Byte на каждый байт;
+            # значение из WriteValue уже им является и уходит без копии
+            if self._notify_fd is not None:
+                # Запись в сокет BlueZ вместо сигнала через dbus-daemon
+                # SEQPACKET: один write - одно уведомление не длиннее MTU
+                fd = self._notify_fd
+                mtu = self._notify_mtu
+                for i in range(0, len(data), mtu):
+                    os.write(fd, data[i:i + mtu])
+            else:
+                if not isinstance(data, _ByteArray):
+                    data = _ByteArray(data)
+                self._emit(self.IFACE, {K_VALUE: data}, [])
+            log.debug("Notified notify-characteristic with: %r", data)
+        except BlockingIOError:
+            # BlueZ не успевает забирать пакеты: оставшееся в этом проходе отбрасываем
+            log.warning("Notify socket is full, dropping notification on %s", self.path)
+            return False
+        except OSError as e:
+            # BlueZ закрыл свою сторону сокета - клиент отписался
+            log.debug("Notify socket closed: %s", e)
+            self._release_notify()
+            return False
+        except Exception as e:
+            log.warning("Failed to send notification: %s", e)
+        return True
 
     # READ Handler
     @dbus.service.method(IFACE, in_signature="a{sv}", out_signature="ay")
     def ReadValue(self, options):
-        return dbus.ByteArray(b"OK")
+        return READ_VALUE
 
     # Notify Start
     @dbus.service.method(IFACE, in_signature="", out_signature="")
     def StartNotify(self):
-        # Включаем флаг уведомлений
+        # Включаем флаг уведомлений, новый подписчик получает и повторное значение
         self.notifying = True
-        print(f"StartNotify called on {self.path}")
+        self._last_value = _SENTINEL
+        log.debug("StartNotify called on %s", self.path)
 
     # Notify Stop
     @dbus.service.method(IFACE, in_signature="", out_signature="")
     def StopNotify(self):
         self.notifying = False
-        print(f"StopNotify called on {self.path}")
+        log.debug("StopNotify called on %s", self.path)
+
+    # Notify через сокет: приложение создаёт socketpair и отдаёт BlueZ один конец
+    @dbus.service.method(IFACE, in_signature="a{sv}", out_signature="hq")
+    def AcquireNotify(self, options):
+        self._release_notify()
+        mtu = int(options.get("mtu", 23))
+        # Неблокирующий, как у самого BlueZ: медленный клиент не останавливает цикл GLib
+        ours, theirs = socket.socketpair(socket.AF_UNIX,
+                                         socket.SOCK_SEQPACKET | socket.SOCK_NONBLOCK)
+        # UnixFd дублирует дескриптор, свою копию конца BlueZ закрываем сразу
+        fd = _UnixFd(theirs)
+        theirs.close()
+        self._notify_fd = ours.detach()
+        self._notify_mtu = mtu - 3  # полезная нагрузка ATT
+        self._notify_watch = GLib.io_add_watch(self._notify_fd, GLib.PRIORITY_DEFAULT,
+                                               GLib.IO_HUP | GLib.IO_ERR, self._on_notify_hup)
+        self.notifying = True
+        self._last_value = _SENTINEL
+        self._set_notify_acquired(True)
+        log.debug("AcquireNotify called on %s, mtu %d", self.path, mtu)
+        return fd, mtu
+
+    def release(self):
+        # Снимает объект с шины и закрывает его дескрипторы и источники GLib
+        self._release_notify()
+        if self._timer_id:
+            GLib.source_remove(self._timer_id)
+            self._timer_id = 0
+        self._pending = []
+        if self._event_fd is not None:
+            GLib.source_remove(self._event_watch)
+            self._event_watch = 0
+            os.close(self._event_fd)
+            self._event_fd = None
+        self.remove_from_connection()
+
+    def _set_notify_acquired(self, value):
+        value = _Boolean(value)
+        self._properties[self.IFACE][K_NOTIFY_ACQUIRED] = value
+        self._emit(self.IFACE, {K_NOTIFY_ACQUIRED: value}, [])
+
+    def _on_notify_hup(self, source, condition):
+        self._notify_watch = 0  # источник снимается возвратом False
+        self._release_notify()
+        return False
+
+    def _release_notify(self):
+        if self._notify_fd is None:
+            return
+        if self._notify_watch:
+            GLib.source_remove(self._notify_watch)
+            self._notify_watch = 0
+        os.close(self._notify_fd)
+        self._notify_fd = None
+        self.notifying = False
+        self._set_notify_acquired(False)
 
 
 # ============================================================
@@ -167,31 +480,57 @@ class Characteristic(dbus.service.Object):
 # ============================================================
 class Descriptor(dbus.service.Object):
     IFACE = "org.bluez.GattDescriptor1"
+    __slots__ = ("path", "_path_obj", "bus", "uuid", "flags",
+                 "characteristic", "_char_path_obj", "value", "_properties")
 
     def __init__(self, bus, index, uuid, flags, characteristic):
         self.path = f"{characteristic.path}/desc{index}"
+        self._path_obj = _ObjectPath(self.path)
         self.bus = bus
         self.uuid = uuid
         self.flags = flags
         self.characteristic = characteristic
+        self._char_path_obj = characteristic._path_obj
+        self.value = CCCD_VALUE
+        self._properties = self._build_properties()
         super().__init__(bus, self.path)
 
     def get_path(self):
-        return dbus.ObjectPath(self.path)
+        return self._path_obj
 
-    def get_properties(self):
+    def _build_properties(self):
         return {
             self.IFACE: {
-                "UUID": self.uuid,
-                "Characteristic": self.characteristic.get_path(),
-                "Flags": self.flags,
+                K_UUID: _as_string(self.uuid),
+                K_CHAR: self._char_path_obj,
+                K_FLAGS: _as_string_array(self.flags),
             }
         }
 
+    def get_properties(self):
+        return self._properties
+
     @dbus.service.method(IFACE, in_signature="a{sv}", out_signature="ay")
     def ReadValue(self, options):
         # По умолчанию читаем CCCD как enabled (0x01 0x00) — это просто пример
-        return dbus.ByteArray(b"\x01\x00")
+        return self.value
+
+    @dbus.service.method(IFACE, in_signature="aya{sv}", out_signature="", byte_arrays=True)
+    def WriteValue(self, value, options):
+        # CCCD - 16 бит little-endian: 0x0001 notify, 0x0002 indicate.
+        # Короткая запись дополняется нулями самим int.from_bytes
+        v = int.from_bytes(value[:2], "little")
+        self.value = _ByteArray(v.to_bytes(2, "little"))
+        # Через StartNotify/StopNotify, чтобы сбросить последнее значение
+        # и закрыть сокет AcquireNotify вместе с подпиской
+        char = self.characteristic
+        if v & 0x0001:
+            if not char.notifying:
+                char.StartNotify()
+        else:
+            char._release_notify()
+            if char.notifying:
+                char.StopNotify()
 
 
 # ============================================================
@@ -200,6 +539,7 @@ class Descriptor(dbus.service.Object):
 def main():
     global MAIN_LOOP
 
+    logging.basicConfig(level=logging.INFO)
     dbus.mainloop.glib.DBusGMainLoop(set_as_default=True)
     bus = dbus.SystemBus()
 
@@ -212,15 +552,15 @@ def main():
     app.add_service(service)
 
     # Write characteristic
-    write_char = Characteristic(bus, 0, WRITE_UUID, ["write", "write-without-response"], service)
+    write_char = Characteristic(bus, 0, WRITE_UUID, FLAGS_WRITE, service)
     service.add_characteristic(write_char)
 
     # Notify characteristic
-    notify_char = Characteristic(bus, 1, NOTIFY_UUID, ["notify", "read"], service)
+    notify_char = Characteristic(bus, 1, NOTIFY_UUID, FLAGS_NOTIFY, service)
     service.add_characteristic(notify_char)
 
     # CCCD descriptor for notify
-    cccd = Descriptor(bus, 0, "00002902-0000-1000-8000-00805f9b34fb", ["read", "write"], notify_char)
+    cccd = Descriptor(bus, 0, CCCD_UUID, FLAGS_CCCD, notify_char)
     notify_char.add_descriptor(cccd)
 
     # Свяжем write-характеристику с notify-характеристикой — чтобы WriteValue мог отправлять уведомления
@@ -232,8 +572,16 @@ def main():
                                 error_handler=lambda e: print("Failed:", e))
 
     MAIN_LOOP = GLib.MainLoop()
+    # Ctrl+C обрабатывается самим циклом GLib: без опроса и без KeyboardInterrupt
+    GLib.unix_signal_add(GLib.PRIORITY_DEFAULT, signal.SIGINT, on_sigint)
     MAIN_LOOP.run()
 
 
+def on_sigint():
+    print("Stopping…")
+    MAIN_LOOP.quit()
+    return GLib.SOURCE_REMOVE
+
+
 if __name__ == "__main__":
     main()